@@ -92,37 +92,41 @@ if not api_key:
 else:
     rag_utils.configure_gemini(api_key)
 
+# Load the embedding models now that the page has rendered, not on the first upload
+rag_utils.preload_models()
+
 if uploaded_pdf and uploaded_image:
     pdf_name = uploaded_pdf.name
     image_name = uploaded_image.name
-    if st.session_state.get("pdf_name") != pdf_name or st.session_state.get("image_name") != image_name or "vector_store" not in st.session_state:
+    if st.session_state.get("pdf_name") != pdf_name or st.session_state.get("image_name") != image_name or "documents_ready" not in st.session_state:
         with st.spinner("Processing your documents... This may take a moment."):
-            # Assumes rag_utils.process_files expects PDF and Image
-            st.session_state.vector_store = rag_utils.process_files(uploaded_pdf, uploaded_image)
+            # Only a flag is kept in session_state; the store itself lives in rag_utils'
+            # TTL-bounded resource cache so it is freed when the session goes idle
+            st.session_state.documents_ready = rag_utils.process_files(uploaded_pdf, uploaded_image) is not None
 
             st.session_state.pdf_name = pdf_name
             st.session_state.image_name = image_name
             if "messages" in st.session_state:
                  st.session_state.messages = []
-        if st.session_state.vector_store:
+        if st.session_state.documents_ready:
             st.success("Documents processed successfully! You can now ask questions.")
         else:
             st.error("Failed to process documents. Please check the files or logs.")
             # Clear state if processing failed
             if "pdf_name" in st.session_state: del st.session_state.pdf_name
             if "image_name" in st.session_state: del st.session_state.image_name
-            if "vector_store" in st.session_state: del st.session_state.vector_store
+            if "documents_ready" in st.session_state: del st.session_state.documents_ready
     else:
         if "messages" not in st.session_state or not st.session_state.messages:
              st.success("Documents already loaded. Ask your questions below.")
 else:
     st.info("Please upload both a PDF and an image file to begin.")
-    if "vector_store" in st.session_state:
+    if "documents_ready" in st.session_state:
         st.session_state.clear()
 
 
 # --- CHAT INTERFACE ---
-if "vector_store" in st.session_state and st.session_state.vector_store:
+if st.session_state.get("documents_ready"):
     if "messages" not in st.session_state:
         st.session_state.messages = []
     for message in st.session_state.messages:
@@ -134,7 +138,9 @@ if "vector_store" in st.session_state and st.session_state.vector_store:
             st.markdown(user_question)
         with st.chat_message("assistant"):
             with st.spinner("Generating answer..."):
-                answer = rag_utils.generate_answer(user_question, st.session_state.vector_store)
+                # Cheap on a cache hit; rebuilt from the disk cache if the TTL evicted it
+                vector_store = rag_utils.process_files(uploaded_pdf, uploaded_image)
+                answer = rag_utils.generate_answer(user_question, vector_store) if vector_store else "Sorry, the documents could not be loaded. Please re-upload them."
                 st.markdown(answer)
         # --- FIX: Removed trailing comma ---
         st.session_state.messages.append({"role": "assistant", "content": answer})
\ No newline at end of file
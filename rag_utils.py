@@ -1,141 +1,537 @@
 import os
 import io
+import re
+import asyncio
 import time
+import pickle
+import hashlib
+import functools
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import streamlit as st
 from PIL import Image
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import faiss
 import fitz  # PyMuPDF
-from sentence_transformers import SentenceTransformer
+import xxhash
+
+# --- CACHE SETTINGS ---
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Dynamically int8-quantized ONNX export published with the model, run on ONNX Runtime
+EMBEDDING_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+IMAGE_EMBEDDING_MODEL_NAME = "clip-ViT-B-32"
+CACHE_DIR = "cache"
+CACHE_VERSION = "9"  # Bump when the stored format or pipeline output changes
+STORE_TTL_SECONDS = 30 * 60  # In-memory vector stores are evicted after this long
+STORE_MAX_ENTRIES = 4
+
+# --- GEMINI REQUEST SETTINGS ---
+# Images are embedded locally with CLIP; set to True to also index Gemini text summaries of them
+SUMMARIZE_IMAGES = False
+SUMMARY_MAX_WORKERS = 8
+GEMINI_MAX_RETRIES = 4
+GEMINI_RETRY_BASE_DELAY = 1.0  # Seconds, doubled after every failed attempt
+RETRYABLE_GEMINI_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+
+# --- VECTOR INDEX SETTINGS ---
+HNSW_MIN_VECTORS = 500  # Brute force is faster than HNSW for small corpora
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+INDEX_QUANTIZER = faiss.ScalarQuantizer.QT_fp16
+TEXT_TOP_K = 5
+IMAGE_TOP_K = 2
+
+# --- PDF EXTRACTION SETTINGS ---
+MIN_IMAGE_AREA = 64 * 64  # Smaller images are almost always decorative
+CHUNK_SIZE = 400  # Characters, keeps chunks within MiniLM's 256-token window
+CHUNK_OVERLAP = 80
+JPEG_QUALITY = 85  # For image payloads sent to Gemini
 
 # --- MODEL LOADING ---
-@st.cache_resource
+# sentence_transformers pulls in torch, so it is imported lazily to keep app startup fast
+@st.cache_resource(show_spinner=False)
 def load_local_embedding_model():
     """Loads the sentence-transformer model from Hugging Face, caching it for performance."""
-    return SentenceTransformer("all-MiniLM-L6-v2")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        backend="onnx",
+        model_kwargs={"file_name": EMBEDDING_ONNX_FILE, "provider": "CPUExecutionProvider"},
+    )
+
+@st.cache_resource(show_spinner=False)
+def load_image_embedding_model():
+    """Loads the CLIP model, which embeds images and text into a shared space."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(IMAGE_EMBEDDING_MODEL_NAME)
+
+@st.cache_resource(show_spinner=False)
+def load_query_encoder():
+    """Returns the tokenizer, ONNX Runtime model and max sequence length behind the local embedding model.
+
+    These are shared with load_local_embedding_model(), so single queries can skip
+    SentenceTransformer.encode's batching machinery.
+    """
+    transformer = load_local_embedding_model()[0]
+    return transformer.tokenizer, transformer.auto_model, transformer.max_seq_length
+
+def preload_models():
+    """Warms the embedding model caches, meant to be called once the page has rendered."""
+    load_local_embedding_model()
+    load_image_embedding_model()
 
 # --- GEMINI CONFIGURATION ---
 def configure_gemini(api_key):
     """Configures the Gemini API with the provided key."""
     genai.configure(api_key=api_key)
 
+# --- QUERY EMBEDDING ---
+def _encode_text_query(user_question):
+    """Embeds one question with a direct ONNX Runtime forward pass, mean pooling and L2 normalization."""
+    import torch
+    tokenizer, encoder, max_length = load_query_encoder()
+    inputs = tokenizer(user_question, return_tensors='pt', truncation=True, max_length=max_length).to(encoder.device)
+    with torch.inference_mode():
+        token_embeddings = encoder(**inputs).last_hidden_state
+        mask = inputs['attention_mask'].unsqueeze(-1).to(token_embeddings.dtype)
+        pooled = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        pooled = torch.nn.functional.normalize(pooled, p=2, dim=1)
+    return pooled.float().cpu().numpy()
+
+@functools.lru_cache(maxsize=512)
+def _encode_query(user_question, for_images=False):
+    """Embeds a question, memoized as raw float32 bytes so repeat questions skip the model."""
+    if not for_images:
+        return _encode_text_query(user_question).tobytes()
+    return load_image_embedding_model().encode(
+        [user_question],
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    ).astype('float32', copy=False).tobytes()
+
+def encode_query(user_question, for_images=False):
+    """Returns the normalized (1, dim) float32 embedding of a question.
+
+    With for_images=True the CLIP text encoder is used, for searching the image index.
+    """
+    return np.frombuffer(_encode_query(user_question, for_images), dtype='float32').reshape(1, -1)
+
+# --- SEMANTIC ANSWER CACHE ---
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Minimum cosine similarity for a cached answer to be reused
+SEMANTIC_CACHE_MAX_ENTRIES = 256
+
+class SemanticAnswerCache:
+    """Caches answers by question embedding, reusing them for near-identical questions."""
+
+    def __init__(self, dimension):
+        self.index = faiss.IndexFlatIP(dimension)
+        self.answers = deque()
+
+    def lookup(self, question_embedding):
+        """Returns the cached answer for a similar question, or None."""
+        if not self.answers:
+            return None
+        scores, ids = self.index.search(question_embedding, 1)
+        if scores[0][0] > SEMANTIC_CACHE_THRESHOLD:
+            return self.answers[ids[0][0]]
+        return None
+
+    def add(self, question_embedding, answer):
+        """Stores an answer, evicting the oldest entry once the cache is full."""
+        if len(self.answers) >= SEMANTIC_CACHE_MAX_ENTRIES:
+            # Removing from a flat index shifts later ids down, keeping them aligned with the deque
+            self.index.remove_ids(np.array([0], dtype='int64'))
+            self.answers.popleft()
+        self.index.add(question_embedding)
+        self.answers.append(answer)
+
+# One answer cache per vector store index, dropped together with the index
+_answer_caches = weakref.WeakKeyDictionary()
+
+def get_answer_cache(index):
+    """Returns the semantic answer cache belonging to a vector store index."""
+    if (answer_cache := _answer_caches.get(index)) is None:
+        answer_cache = _answer_caches[index] = SemanticAnswerCache(index.d)
+    return answer_cache
+
 # --- DATA EXTRACTION & PROCESSING ---
-def extract_pdf_content(uploaded_pdf):
-    """Extracts all text and images from an uploaded PDF file."""
+def _chunk(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Yields windows of at most `size` characters split on sentence boundaries, overlapping by up to `overlap` characters."""
+    sentences = []
+    for sentence in re.split(r'(?<=[.!?])\s+', text):
+        # Sentences too long for one window are split into overlapping pieces
+        if len(sentence) > size:
+            sentences.extend(sentence[i:i + size] for i in range(0, len(sentence) - overlap, size - overlap))
+        elif sentence:
+            sentences.append(sentence)
+
+    current = ""
+    for sentence in sentences:
+        if not current:
+            current = sentence
+        elif len(current) + 1 + len(sentence) <= size:
+            current = f"{current} {sentence}"
+        else:
+            yield current
+            # Carry over the trailing words of the previous window
+            tail = current[-overlap:]
+            tail = tail[tail.find(" ") + 1:] if " " in tail else tail
+            current = f"{tail} {sentence}" if len(tail) + 1 + len(sentence) <= size else sentence
+    if current:
+        yield current
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def extract_pdf_content(pdf_bytes):
+    """Extracts text chunks and images from the bytes of a PDF file, cached across reruns.
+
+    Returns the content store and a parallel list of (page_number, item_index) sources.
+    """
     content_store = []
-    pdf_document = fitz.open(stream=uploaded_pdf.getvalue(), filetype="pdf")
-    
+    content_sources = []
+    seen_xrefs = set()
+    seen_chunk_hashes = set()
+    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+
     for page_num, page in enumerate(pdf_document):
         # Extract text
         if page_text := page.get_text("text").strip():
-            content_store.append(page_text)
-        
+            for chunk_idx, chunk in enumerate(_chunk(page_text)):
+                # Headers, footers and boilerplate repeat verbatim across pages
+                chunk_hash = xxhash.xxh64_intdigest(chunk)
+                if chunk_hash in seen_chunk_hashes:
+                    continue
+                seen_chunk_hashes.add(chunk_hash)
+                content_store.append(chunk)
+                content_sources.append((page_num + 1, chunk_idx))
+
         # Extract images
         image_list = page.get_images(full=True)
         for img_index, img in enumerate(image_list):
-            xref = img[0]
+            xref, _, width, height = img[:4]
+            # Images reused across pages (logos, backgrounds) share an xref
+            if xref in seen_xrefs:
+                continue
+            seen_xrefs.add(xref)
+            if width * height < MIN_IMAGE_AREA:
+                continue
             try:
                 base_image = pdf_document.extract_image(xref)
                 image_bytes = base_image["image"]
-                # Convert bytes to PIL Image
+                # Convert bytes to PIL Image, decoding once up front so CLIP and Gemini
+                # reuse the pixels instead of each triggering a lazy decode
                 pil_image = Image.open(io.BytesIO(image_bytes))
+                pil_image.load()
+                pil_image = pil_image.convert("RGB")
                 content_store.append(pil_image)
+                content_sources.append((page_num + 1, img_index))
             except Exception as e:
                 st.warning(f"Warning: Could not extract image {img_index} from page {page_num+1}. Skipping. Error: {e}")
-                
-    return content_store
 
-def summarize_image(image):
-    """Generates a text summary of an image using Gemini Pro Vision."""
-   
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    prompt_parts = [
+    return content_store, content_sources
+
+def generate_with_retry(model, prompt_parts):
+    """Calls Gemini, retrying with exponential backoff on rate limits and server errors."""
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            return model.generate_content(prompt_parts)
+        except RETRYABLE_GEMINI_ERRORS:
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            time.sleep(GEMINI_RETRY_BASE_DELAY * 2 ** attempt)
+
+async def generate_with_retry_async(model, prompt_parts):
+    """Async variant of generate_with_retry, backing off without blocking the event loop."""
+    for attempt in range(GEMINI_MAX_RETRIES):
+        try:
+            return await model.generate_content_async(prompt_parts)
+        except RETRYABLE_GEMINI_ERRORS:
+            if attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(GEMINI_RETRY_BASE_DELAY * 2 ** attempt)
+
+def _image_summary_prompt(image):
+    """Builds the Gemini prompt asking for a summary of an image."""
+    return [
         "You are an expert at analyzing images and charts.",
         "Provide a detailed, objective summary of the contents of this image.",
         "Describe the key elements, data points, and overall conclusion the image conveys.",
         image
     ]
+
+def _summarize_image(image):
+    """Requests a text summary of an image from Gemini, raising on failure."""
+    model = genai.GenerativeModel('gemini-2.5-flash')
+    return generate_with_retry(model, _image_summary_prompt(image)).text
+
+async def _summarize_image_async(image, semaphore):
+    """Requests a text summary of an image from Gemini without blocking, raising on failure."""
+    model = genai.GenerativeModel('gemini-2.5-flash')
+    async with semaphore:
+        response = await generate_with_retry_async(model, _image_summary_prompt(image))
+    return response.text
+
+async def _summarize_images_async(images):
+    """Summarizes images concurrently on one event loop, returning summaries or exceptions in input order."""
+    semaphore = asyncio.Semaphore(SUMMARY_MAX_WORKERS)
+    return await asyncio.gather(
+        *(_summarize_image_async(image, semaphore) for image in images),
+        return_exceptions=True,
+    )
+
+def summarize_image(image):
+    """Generates a text summary of an image using Gemini Pro Vision."""
     try:
-        response = model.generate_content(prompt_parts)
-        return response.text
+        return _summarize_image(image)
     except Exception as e:
         st.error(f"Error generating image summary: {e}")
         return None
 
+def summarize_images(images):
+    """Summarizes several images concurrently, returning summaries in input order."""
+    if not images:
+        return []
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        results = asyncio.run(_summarize_images_async(images))
+    else:
+        # asyncio.run cannot be nested inside a running loop, fall back to threads
+        with ThreadPoolExecutor(max_workers=SUMMARY_MAX_WORKERS) as executor:
+            futures = [executor.submit(_summarize_image, image) for image in images]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    # Streamlit elements must be created from the script thread, so errors are reported here
+    summaries = []
+    for result in results:
+        if isinstance(result, Exception):
+            st.error(f"Error generating image summary: {result}")
+            summaries.append(None)
+        else:
+            summaries.append(result)
+    return summaries
+
 # --- EMBEDDING & VECTOR STORE ---
 def get_local_embeddings(texts, local_model):
     """Generates embeddings for a list of texts using a local model."""
-    with st.spinner(f"Embedding {len(texts)} text/image chunks locally..."):
-        return local_model.encode(texts).tolist()
+    with st.spinner(f"Embedding {len(texts)} text chunks locally..."):
+        return local_model.encode(
+            texts,
+            batch_size=64,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype('float32', copy=False)
+
+def get_image_embeddings(images, image_model):
+    """Generates embeddings for a list of PIL images using a local CLIP model."""
+    with st.spinner(f"Embedding {len(images)} images locally..."):
+        return image_model.encode(
+            images,
+            batch_size=16,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype('float32', copy=False)
+
+def create_index(embeddings, ids, dimension):
+    """Creates a FAISS index over normalized embeddings, labelled with their content_store positions."""
+    # Embeddings are L2-normalized, so inner product == cosine similarity.
+    # Vectors are stored as float16, halving index memory and on-disk cache size.
+    if len(ids) < HNSW_MIN_VECTORS:
+        base_index = faiss.IndexScalarQuantizer(dimension, INDEX_QUANTIZER, faiss.METRIC_INNER_PRODUCT)
+    else:
+        base_index = faiss.IndexHNSWSQ(dimension, INDEX_QUANTIZER, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        base_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        base_index.hnsw.efSearch = HNSW_EF_SEARCH
+    index = faiss.IndexIDMap(base_index)
+    if len(ids):
+        embeddings_np = np.ascontiguousarray(embeddings, dtype='float32')
+        index.train(embeddings_np)
+        index.add_with_ids(embeddings_np, np.asarray(ids, dtype='int64'))
+    return index
 
-def create_vector_store(embeddings, content_store):
-    """Creates a FAISS vector store."""
-    embeddings_np = np.array(embeddings).astype('float32')
-    dimension = embeddings_np.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings_np)
-    return (index, content_store)
+def create_vector_store(text_index, image_index, content_store, content_sources):
+    """Bundles the text and image indices with the content they point into."""
+    return (text_index, image_index, content_store, content_sources)
+
+# --- DISK CACHE ---
+def _cache_key(pdf_bytes, image_bytes=None):
+    """Builds a cache key from the uploaded file bytes, the embedding models and the cache version."""
+    hasher = hashlib.sha256()
+    hasher.update(f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_ONNX_FILE}:{IMAGE_EMBEDDING_MODEL_NAME}:{CACHE_VERSION}:".encode())
+    # Length prefix keeps the PDF/image boundary unambiguous
+    hasher.update(f"{len(pdf_bytes)}:".encode())
+    hasher.update(pdf_bytes)
+    if image_bytes:
+        hasher.update(image_bytes)
+    return hasher.hexdigest()
+
+def load_cached_vector_store(cache_key):
+    """Loads a previously saved vector store from disk, or returns None on a miss."""
+    cache_path = os.path.join(CACHE_DIR, cache_key)
+    text_index_path = os.path.join(cache_path, "text_index.faiss")
+    if not os.path.exists(text_index_path):
+        return None
+    try:
+        with open(os.path.join(cache_path, "content_store.pkl"), "rb") as f:
+            content_store, content_sources = pickle.load(f)
+        image_index = faiss.read_index(os.path.join(cache_path, "image_index.faiss"))
+        text_index = faiss.read_index(text_index_path)
+    except Exception as e:
+        st.warning(f"Warning: Could not load cached data, reprocessing. Error: {e}")
+        return None
+    return create_vector_store(text_index, image_index, content_store, content_sources)
+
+def save_vector_store(cache_key, vector_store):
+    """Saves a vector store to disk so identical uploads can skip processing."""
+    text_index, image_index, content_store, content_sources = vector_store
+    cache_path = os.path.join(CACHE_DIR, cache_key)
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        with open(os.path.join(cache_path, "content_store.pkl"), "wb") as f:
+            pickle.dump((content_store, content_sources), f, protocol=pickle.HIGHEST_PROTOCOL)
+        faiss.write_index(image_index, os.path.join(cache_path, "image_index.faiss"))
+        # The text index is written last, its presence marks a complete cache entry
+        faiss.write_index(text_index, os.path.join(cache_path, "text_index.faiss"))
+    except Exception as e:
+        st.warning(f"Warning: Could not write cache to disk. Error: {e}")
+
+# --- GEMINI IMAGE PAYLOADS ---
+def _to_jpeg_bytes(image, quality=JPEG_QUALITY):
+    """Encodes a PIL image as JPEG bytes."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+def _to_image_part(image):
+    """Converts a PIL image to an inline-data part that Gemini accepts as-is."""
+    return {"mime_type": "image/jpeg", "data": _to_jpeg_bytes(image)}
 
 # --- MAIN PIPELINE ---
-def process_files(uploaded_pdf):
-    """Complete pipeline to process files and create a vector store."""
-    local_model = load_local_embedding_model()
+def _load_uploaded_image(image_bytes):
+    """Decodes an uploaded image file into an RGB PIL image."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    return image.convert("RGB")
 
-    content_store = extract_pdf_content(uploaded_pdf)
-    
-    all_texts_to_embed = []
-    with st.spinner("Summarizing images with Gemini..."):
-        for item in content_store:
-            if isinstance(item, str):
-                all_texts_to_embed.append(item)
-            elif isinstance(item, Image.Image):
-                image_summary = summarize_image(item)
+# Keyed by content hash (the underscored byte arguments are not hashed by Streamlit), so
+# identical uploads share one store across sessions and idle stores are freed after the TTL
+# instead of living in session_state for as long as the tab's session does.
+@st.cache_resource(ttl=STORE_TTL_SECONDS, max_entries=STORE_MAX_ENTRIES, show_spinner=False)
+def _build_store(cache_key, _pdf_bytes, _image_bytes=None):
+    """Loads the vector store from the disk cache, or builds it, raising ValueError if there is no content."""
+    if (cached_store := load_cached_vector_store(cache_key)) is not None:
+        return cached_store
+
+    content_store, content_sources = extract_pdf_content(_pdf_bytes)
+    if _image_bytes:
+        try:
+            content_store.append(_load_uploaded_image(_image_bytes))
+            # No page number: the image was uploaded alongside the PDF
+            content_sources.append((None, 0))
+        except Exception as e:
+            st.warning(f"Warning: Could not read the uploaded image. Skipping. Error: {e}")
+    if not content_store:
+        raise ValueError("No text or image content could be processed from the PDF.")
+
+    text_ids = [i for i, item in enumerate(content_store) if isinstance(item, str)]
+    image_ids = [i for i, item in enumerate(content_store) if isinstance(item, Image.Image)]
+    texts_to_embed = [content_store[i] for i in text_ids]
+    images = [content_store[i] for i in image_ids]
+
+    if SUMMARIZE_IMAGES and images:
+        with st.spinner("Summarizing images with Gemini..."):
+            for image_id, image_summary in zip(image_ids, summarize_images(images)):
                 if image_summary:
-                    all_texts_to_embed.append(image_summary)
+                    # The summary is searchable as text but still resolves to the image itself
+                    text_ids.append(image_id)
+                    texts_to_embed.append(image_summary)
                 else:
-                    st.error("Failed to summarize an image, it will be skipped in context.")
+                    st.error("Failed to summarize an image, it will only be searchable by its CLIP embedding.")
 
-    if not all_texts_to_embed:
-         st.error("No text or image content could be processed from the PDF.")
-         return None
+    local_model = load_local_embedding_model()
+    image_model = load_image_embedding_model()
+    text_embeddings = get_local_embeddings(texts_to_embed, local_model) if texts_to_embed else None
+    image_embeddings = get_image_embeddings(images, image_model) if images else None
+    text_index = create_index(text_embeddings, text_ids, local_model.get_sentence_embedding_dimension())
+    image_index = create_index(image_embeddings, image_ids, image_model.get_sentence_embedding_dimension())
 
-    all_embeddings = get_local_embeddings(all_texts_to_embed, local_model)
-    
-    # The content_store already contains the original text and images
-    return create_vector_store(all_embeddings, content_store)
+    # Encode each image for Gemini once here instead of on every question
+    for image_id, image in zip(image_ids, images):
+        content_store[image_id] = _to_image_part(image)
+
+    # The content_store now holds the original text and Gemini-ready image parts
+    vector_store = create_vector_store(text_index, image_index, content_store, content_sources)
+    save_vector_store(cache_key, vector_store)
+    return vector_store
+
+def process_files(uploaded_pdf, uploaded_image=None):
+    """Complete pipeline to process files and create a vector store."""
+    pdf_bytes = uploaded_pdf.getvalue()
+    image_bytes = uploaded_image.getvalue() if uploaded_image else None
+    try:
+        return _build_store(_cache_key(pdf_bytes, image_bytes), pdf_bytes, image_bytes)
+    except ValueError as e:
+        st.error(str(e))
+        return None
 
 # --- ANSWER GENERATION ---
+# Kept identical across turns so it forms a cacheable prompt prefix
+ANSWER_SYSTEM_INSTRUCTION = "You are an expert analyst. Answer the user's question based ONLY on the following context. If the context does not contain the answer, state that you don't know."
+
 def generate_answer(user_question, vector_store):
     """Generates an answer using the RAG pipeline."""
-    index, content_store = vector_store
-    local_model = load_local_embedding_model()
+    text_index, image_index, content_store, content_sources = vector_store
 
-    question_embedding = local_model.encode([user_question]).astype('float32')
-    
-    k = 5 # Retrieve top 5 relevant chunks
-    _, indices = index.search(question_embedding, k)
-    
-    valid_indices = [i for i in indices[0] if i < len(content_store)]
-    retrieved_context = [content_store[i] for i in valid_indices]
-    
-    prompt_parts = [
-        "You are an expert analyst. Answer the user's question based ONLY on the following context. If the context does not contain the answer, state that you don't know.",
-        "\n--- CONTEXT START ---\n"
-    ]
-    for item in retrieved_context:
+    question_embedding = encode_query(user_question)
+
+    answer_cache = get_answer_cache(text_index)
+    if (cached_answer := answer_cache.lookup(question_embedding)) is not None:
+        return cached_answer
+
+    # Index ids are content_store positions; empty result slots come back as -1
+    _, text_indices = text_index.search(question_embedding, TEXT_TOP_K)
+    _, image_indices = image_index.search(encode_query(user_question, for_images=True), IMAGE_TOP_K)
+    indices = np.concatenate((text_indices, image_indices), axis=1)
+
+    candidates = indices[0]
+    valid = candidates[(candidates >= 0) & (candidates < len(content_store))]
+    # Order context by position in the document rather than by score, so the same
+    # chunks always produce the same prompt and Gemini can reuse its prompt cache
+    valid_indices = sorted(set(valid.tolist()))
+    retrieved_context = [(content_store[i], content_sources[i][0]) for i in valid_indices]
+
+    prompt_parts = ["\n--- CONTEXT START ---\n"]
+    for item, page_number in retrieved_context:
+        source = f"page {page_number}" if page_number is not None else "the uploaded image"
         if isinstance(item, str):
-            prompt_parts.append(item)
-        elif isinstance(item, Image.Image):
-            # Pass the actual image object to Gemini
-            prompt_parts.append("\n[Image context below]\n") 
+            prompt_parts.append(f"\n[From {source}]\n{item}")
+        elif isinstance(item, dict):
+            # Pass the pre-encoded image part straight to Gemini
+            prompt_parts.append(f"\n[Image context from {source} below]\n")
             prompt_parts.append(item)
             prompt_parts.append("\n[End of image context]\n")
     prompt_parts.append(f"\n--- CONTEXT END ---\n\nQuestion: {user_question}\n\nAnswer:")
     
-    model = genai.GenerativeModel('gemini-2.5-flash') # Use the appropriate model
+    model = genai.GenerativeModel('gemini-2.5-flash', system_instruction=ANSWER_SYSTEM_INSTRUCTION) # Use the appropriate model
     try:
-        response = model.generate_content(prompt_parts)
+        response = generate_with_retry(model, prompt_parts)
+        answer_cache.add(question_embedding, response.text)
         return response.text
     except Exception as e:
         st.error(f"Error generating answer from Gemini: {e}")